@@ -1,204 +1,874 @@
+import atexit
+import errno
+import gzip
 import logging
 import os
-import random
+import queue
+import re
+import selectors
+import signal
 import socket
-from typing import Tuple
+import time
+from types import FrameType, TracebackType
+from collections import OrderedDict, deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, ClassVar, Deque, Dict, List, NoReturn, Optional, Pattern, Tuple, Type, Union
 
-import magic
-import yaml
+import magic  # type: ignore[import-not-found]
+import yaml  # type: ignore[import-untyped]
 
 import utils
 from validators import port_validation, check_port_open
 
 LOGGER_FILE = "./logs/server.log"
 # Настройки логирования
-logging.basicConfig(
-    format="%(asctime)-15s [%(levelname)s] %(funcName)s: %(message)s",
-    handlers=[logging.FileHandler(LOGGER_FILE)],
-    level=logging.INFO,
-)
-logger = logging.getLogger(__name__)
+file_handler = logging.FileHandler(LOGGER_FILE)
+file_handler.setFormatter(logging.Formatter("%(asctime)-15s [%(levelname)s] %(funcName)s: %(message)s"))
 stream_handler = logging.StreamHandler()
 stream_handler.setLevel(logging.INFO)
-logger.addHandler(stream_handler)
+# Запись в файл и в консоль идет в фоновом потоке, а не в обработчике запроса
+log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(handlers=[queue_handler], level=logging.INFO)
+log_listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
 
 
-def read_config() -> dict:
+def read_config() -> Dict[str, Any]:
     """Чтение настроек из файла yaml"""
     with open("settings.yml", "r") as file:
-        return yaml.safe_load(file)
+        config: Dict[str, Any] = yaml.safe_load(file)
+    return config
 
 
 class BrowserRequest:
     """Экземпляр запроса браузера"""
 
-    def __init__(self, data: bytes):
-        lines = []
-        # Удаляем все пробелы с запроса браузера
-        for d in data.decode("utf8", "replace").split("\n"):
-            line = d.strip()
-            if line:
-                lines.append(line)
+    __slots__ = ("method", "path", "http_version", "_buf", "_head_start", "_head_end", "_fields")
+
+    HTTP_VERSIONS = (b"HTTP/1.0", b"HTTP/1.1")
+
+    # Имена полей заголовка для часто запрашиваемых атрибутов
+    _NAME_MAP = {
+        "host": "Host",
+        "user_agent": "User-Agent",
+        "accept": "Accept",
+        "accept_encoding": "Accept-Encoding",
+        "accept_language": "Accept-Language",
+        "connection": "Connection",
+        "content_length": "Content-Length",
+        "content_type": "Content-Type",
+        "cookie": "Cookie",
+        "referer": "Referer",
+    }
+
+    # Маркеры полей заголовка по имени: точный и без учета регистра
+    _markers: ClassVar[Dict[str, Tuple[bytes, Pattern[bytes]]]] = {}
+
+    def __init__(self, data: Optional[bytes] = None):
+        self._fields: Dict[str, str] = {}
+        if data is not None and self.parse_into(bytearray(data), 0, len(data)) == -1:
+            raise ValueError("Заголовок запроса получен не полностью")
+
+    def parse_into(self, buf: bytearray, start: int, stop: int) -> int:
+        """
+        Разбирает запрос из buf[start:stop] на месте, чтобы экземпляр можно было переиспользовать
 
-        self.method, self.path, self.http_version = lines.pop(0).split(" ")
-        self.info = {k: v for k, v in (line.split(": ") for line in lines)}
+        Копируется только строка запроса, поля заголовка ищутся прямо в buf при обращении,
+        поэтому запросом можно пользоваться, пока buf не перезаписан.
+        Возвращает индекс, с которого начинается следующий запрос,
+        или -1, если заголовок получен не полностью
+        """
+        self._fields.clear()
+        # Пустые строки перед строкой запроса пропускаем
+        while buf.startswith(b"\r\n", start, stop):
+            start += 2
+        line_end = buf.find(b"\n", start, stop)
+        if line_end == -1:
+            return -1
+        if line_end == start or buf[line_end - 1] != ord("\r"):
+            raise ValueError("Строка запроса должна заканчиваться CRLF")
+        line_end -= 1
+        # Заголовок запроса отделен от тела пустой строкой
+        end = buf.find(b"\r\n\r\n", line_end, stop)
+        if end == -1:
+            return -1
+        # Поле, отделенное одним LF, часть серверов и прокси считает отдельной строкой
+        if buf.count(b"\n", line_end, end) != buf.count(b"\r\n", line_end, end):
+            raise ValueError("Строки заголовка должны заканчиваться CRLF")
+
+        method, path, http_version = buf[start:line_end].split(b" ")
+        if http_version not in self.HTTP_VERSIONS:
+            raise ValueError(f"Неподдерживаемая версия протокола {http_version!r}")
+        self.method = method.decode("ascii")
+        self.path = path.decode("ascii")
+        self.http_version = http_version.decode("ascii")
+        # Поля заголовка: от перевода строки после строки запроса до конца заголовка
+        self._buf = buf
+        self._head_start = line_end
+        self._head_end = end
+        return end + 4
 
     def __repr__(self) -> str:
         return f"<BrowserRequest {self.method} {self.path} {self.http_version}>"
 
-    def __getattr__(self, name: str):
+    @property
+    def keep_alive(self) -> bool:
+        """Просит ли клиент оставить соединение открытым после ответа"""
+        # Тело запроса не читается, поэтому соединение переиспользуется только без тела:
+        # без Transfer-Encoding и с единственным Content-Length: 0. Иначе неоднозначная
+        # длина позволила бы выдать тело за следующий запрос
+        if self.find("Transfer-Encoding") is not None:
+            return False
+        lengths = self._marker("Content-Length")[1].findall(self._buf, self._head_start, self._head_end)
+        if lengths and (len(lengths) > 1 or self.find("Content-Length") != "0"):
+            return False
+        connection = self.get("Connection").lower()
+        if self.http_version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    def get(self, name: str, default: str = "") -> str:
+        """Значение поля заголовка name или default, если его нет"""
+        value = self.find(name)
+        return default if value is None else value
+
+    @classmethod
+    def _marker(cls, name: str) -> Tuple[bytes, Pattern[bytes]]:
+        """Маркеры начала поля name в заголовке"""
+        try:
+            return cls._markers[name]
+        except KeyError:
+            pass
+        marker = b"\r\n" + name.encode("ascii") + b":"
+        # Пробелы перед двоеточием запрещены, но учитываем их, чтобы такое поле не осталось незамеченным
+        pattern = re.compile(re.escape(marker[:-1]) + rb"[ \t]*:", re.IGNORECASE)
+        cls._markers[name] = marker, pattern
+        return marker, pattern
+
+    def find(self, name: str) -> Optional[str]:
+        """Значение поля заголовка name без окружающих пробелов или None, если его нет"""
+        marker, pattern = self._marker(name)
+        buf, head_start, head_end = self._buf, self._head_start, self._head_end
+        start = buf.find(marker, head_start, head_end)
+        if start != -1:
+            start += len(marker)
+        else:
+            # Имена полей нечувствительны к регистру: ищем прямо в buf, без копии заголовка
+            match = pattern.search(buf, head_start, head_end)
+            if match is None:
+                return None
+            start = match.end()
+        end = buf.find(b"\r\n", start, head_end)
+        return buf[start:end if end != -1 else head_end].strip(b" \t").decode("utf8", "replace")
+
+    def __getattr__(self, name: str) -> str:
+        if name.startswith("_"):
+            raise AttributeError(name)
         try:
-            return self.info["-".join([n.capitalize() for n in name.split("_")])]
-        except IndexError:
+            return self._fields[name]
+        except KeyError:
+            pass
+        key = self._NAME_MAP.get(name) or "-".join([n.capitalize() for n in name.split("_")])
+        value = self.find(key)
+        if value is None:
             raise AttributeError(name)
+        # Запоминаем до следующего parse_into
+        self._fields[name] = value
+        return value
+
+
+# Свободные экземпляры запросов, чтобы не создавать объект на каждый запрос
+_request_pool: Deque[BrowserRequest] = deque(maxlen=256)
+
+
+class CachedFile:
+    """
+    Открытый файл из кэша сервера
+
+    Один дескриптор используется кэшем и всеми соединениями, которые отдают файл
+    через sendfile, поэтому он закрывается, когда на файл не остается ссылок
+    """
+
+    __slots__ = ("fd",)
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def __del__(self) -> None:
+        os.close(self.fd)
+
+
+class CacheEntry:
+    """Файл в кэше сервера"""
+
+    __slots__ = ("body", "mtime", "gz", "size")
+
+    def __init__(self, body: Union[bytes, CachedFile], mtime: float, size: int):
+        # Содержимое небольшого файла или открытый большой файл
+        self.body = body
+        self.mtime = mtime
+        # Сжатое gzip содержимое, создается при первом запросе с Accept-Encoding: gzip
+        self.gz: Optional[bytes] = None
+        self.size = size
+
+
+class ClientConnection:
+    """Клиентское соединение с буфером исходящих данных"""
+
+    __slots__ = (
+        "sock", "address", "pending", "closed", "_out", "_file", "_offset", "_remaining", "keep_alive", "last_active"
+    )
+
+    def __init__(self, sock: socket.socket, address: Tuple[str, int]):
+        self.sock = sock
+        self.address = address
+        # Принятые, но еще не разобранные данные: неполный заголовок или следующие запросы
+        self.pending = bytearray()
+        self.closed = False
+        self._out: List[memoryview] = []
+        self._file: Optional[CachedFile] = None
+        self._offset: int = 0
+        self._remaining: int = 0
+        self.keep_alive: bool = False
+        self.last_active: float = time.monotonic()
+
+    def __repr__(self) -> str:
+        return f"<ClientConnection {self.address[0]}:{self.address[1]}>"
+
+    def recv_into(self, buffer: memoryview) -> int:
+        return self.sock.recv_into(buffer)
+
+    def queue(self, data: List[bytes], file: Optional[CachedFile] = None, size: int = 0,
+              keep_alive: bool = False) -> None:
+        """
+        Ставит данные в очередь на отправку
+
+        data       -- заголовок и тело ответа из памяти, отправляются без склеивания
+        file       -- файл с телом ответа, отдается через sendfile
+        size       -- размер тела ответа в файле
+        keep_alive -- не закрывать соединение после ответа
+        """
+        self.keep_alive = keep_alive
+        self._out = [memoryview(d) for d in data if d]
+        self._file = file
+        self._offset = 0
+        self._remaining = size
+
+    def flush(self) -> bool:
+        """
+        Отправляет столько данных, сколько примет сокет
+
+        Возвращает True, если весь ответ отправлен
+        """
+        while self._out:
+            # MSG_MORE: заголовок уйдет в одном сегменте с началом файла
+            flags = socket.MSG_MORE if self._remaining else 0
+            try:
+                sent = self.sock.sendmsg(self._out, [], flags)
+            except BlockingIOError:
+                return False
+            # Отбрасываем полностью отправленные буферы
+            while sent:
+                if sent >= len(self._out[0]):
+                    sent -= len(self._out.pop(0))
+                else:
+                    self._out[0] = self._out[0][sent:]
+                    sent = 0
+        # Тело ответа копируется из файла в сокет внутри ядра
+        file = self._file
+        while self._remaining:
+            assert file is not None, "Нет файла с телом ответа"
+            try:
+                sent = os.sendfile(self.sock.fileno(), file.fileno(), self._offset, self._remaining)
+            except BlockingIOError:
+                return False
+            if not sent:
+                # Файл оказался короче Content-length: клиент ждет недостающие байты
+                self.keep_alive = False
+                break
+            self._offset += sent
+            self._remaining -= sent
+        self.release_file()
+        return True
+
+    @property
+    def sending(self) -> bool:
+        """Есть ли неотправленная часть ответа"""
+        return bool(self._out or self._remaining)
+
+    def release_file(self) -> None:
+        self._file = None
+
+    def close(self) -> None:
+        self.closed = True
+        self.release_file()
+        self.sock.close()
 
 
 class LocaleSocket:
     """Класс для работы с сокетами"""
 
-    def __init__(self, host="", port=80, buffer_size=1024, max_queued_connections=5):
-        self._connection = None
-        self._socket = None
+    __slots__ = (
+        "_selector", "_socket", "host", "port", "buffer_size", "max_head_size", "max_queued_connections",
+        "keep_alive_timeout", "_last_sweep", "_accept_paused", "_recv_buf", "_recv_view"
+    )
+
+    # Сколько соединений принимать за одно пробуждение селектора
+    ACCEPT_BATCH = 64
+
+    # Ошибки accept, после которых новых клиентов сейчас не принять: кончились дескрипторы или память
+    ACCEPT_EXHAUSTED = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+    def __init__(
+            self,
+            host: str = "",
+            port: int = 80,
+            buffer_size: int = 1024,
+            max_head_size: int = 8192,
+            max_queued_connections: int = socket.SOMAXCONN,
+            keep_alive_timeout: float = 5.0,
+    ):
+        self._selector: Optional[selectors.BaseSelector] = None
+        self._socket: Optional[socket.socket] = None
         self.host = host
         self.port = port
         self.buffer_size = buffer_size
+        # Заголовок запроса принимается за несколько чтений по buffer_size, но не больше этого размера
+        self.max_head_size = max_head_size
+        # Соединения сверх этой очереди ядро отбрасывает еще до accept, и клиенты повторяют попытку позже
         self.max_queued_connections = max_queued_connections
+        self.keep_alive_timeout = keep_alive_timeout
+        self._last_sweep = time.monotonic()
+        # Прием новых клиентов приостановлен до следующей проверки простаивающих соединений
+        self._accept_paused = False
+        # Общий буфер приема: запрос разбирается сразу после чтения
+        self._recv_buf = bytearray(buffer_size)
+        self._recv_view = memoryview(self._recv_buf)
 
     def __repr__(self) -> str:
         status = "closed" if self._socket is None else "open"
         return f"<{status} ServerSocket {self.host}:{self.port}>"
 
-    def __enter__(self):
+    def __enter__(self) -> "LocaleSocket":
         self.open()
         return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def __exit__(
+            self,
+            exc_type: Optional[Type[BaseException]],
+            exc_val: Optional[BaseException],
+            exc_tb: Optional[TracebackType],
+    ) -> None:
         self.close()
 
-    def open(self):
+    def open(self, listen: bool = True) -> None:
+        """
+        Открывает сокет сервера
+
+        listen -- при False сокет только занимает порт и не принимает соединения
+        """
         assert self._socket is None, "ServerSocket уже открыт"
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Несколько процессов слушают один порт, ядро распределяет между ними соединения
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             self._socket.bind((self.host, self.port))
         except Exception:
-            self.close()
+            self._socket.close()
+            self._socket = None
             raise
-        else:
-            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # При port=0 порт выбирает система
+        self.port = self._socket.getsockname()[1]
+        if not listen:
+            return
+        self._socket.listen(self.max_queued_connections)
+        # Неблокирующий режим: один поток обслуживает много клиентов
+        self._socket.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
 
-    def close(self):
+    def close(self) -> None:
         assert self._socket is not None, "Данный ServerSocket уже был закрыт"
-        if self._connection:
-            self._connection.close()
-            self._connection = None
+        if self._selector is not None:
+            for key in list(self._selector.get_map().values()):
+                if key.data is not None:
+                    key.data.close()
+            self._selector.close()
+            self._selector = None
         self._socket.close()
         self._socket = None
 
-    def listen(self) -> Tuple[BrowserRequest, str]:
-        assert (self._socket is not None), "ServerSocket должен быть открыт для получения данных"
-        self._socket.listen(self.max_queued_connections)
-        self._connection, address = self._socket.accept()
-        data = self._connection.recv(self.buffer_size)
-        return BrowserRequest(data), address[0]
+    @property
+    def is_open(self) -> bool:
+        return self._socket is not None
 
-    def send(self, data: bytes):
-        assert self._socket is not None, "ServerSocket должен быть открыт для ответа"
-        self._connection.send(data)
-        self._connection.close()
+    @property
+    def selector(self) -> selectors.BaseSelector:
+        assert self._selector is not None, "ServerSocket должен быть открыт для получения данных"
+        return self._selector
+
+    def poll(self, timeout: Optional[float] = None) -> List[Tuple[selectors.SelectorKey, int]]:
+        """Ожидает событий на сокете сервера и клиентских сокетах"""
+        return self.selector.select(timeout)
+
+    def accept(self) -> None:
+        """
+        Принимает новых клиентов и регистрирует их на чтение
+
+        За одно пробуждение разбирается вся очередь ожидающих соединений,
+        но не больше ACCEPT_BATCH, чтобы не задерживать уже подключенных клиентов
+        """
+        server_socket, selector = self._socket, self.selector
+        assert server_socket is not None
+        for _ in range(self.ACCEPT_BATCH):
+            try:
+                sock, address = server_socket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno not in self.ACCEPT_EXHAUSTED:
+                    # Клиент отключился, не дождавшись accept: принимаем следующего
+                    continue
+                # Освобождаем дескрипторы простаивающих keep-alive соединений, а если таких нет,
+                # перестаем слушать сокет до следующей проверки, чтобы не крутить цикл впустую
+                if not self.drop_idle(0):
+                    logger.warning("Не удалось принять соединение: %s, прием приостановлен", e)
+                    selector.unregister(server_socket)
+                    self._accept_paused = True
+                return
+            sock.setblocking(False)
+            # Без задержки Нейгла для небольших ответов
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            selector.register(sock, selectors.EVENT_READ, ClientConnection(sock, address))
+
+    def recv(self, connection: ClientConnection) -> Optional[Tuple[bytearray, int]]:
+        """
+        Читает данные клиента, None - если клиент отключился
+
+        Возвращает буфер и длину данных в нем. Обычно это общий буфер приема,
+        а если от прошлого чтения остались данные, новые дописываются к ним
+        """
+        pending = connection.pending
+        try:
+            size = connection.recv_into(self._recv_view)
+        except BlockingIOError:
+            return None
+        except OSError:
+            size = 0
+        if not size:
+            self.disconnect(connection)
+            return None
+        connection.last_active = time.monotonic()
+        if not pending:
+            return self._recv_buf, size
+        pending += self._recv_view[:size]
+        connection.pending = bytearray()
+        return pending, len(pending)
+
+    def next_request(self, buf: bytearray, start: int, stop: int) -> Tuple[Optional[BrowserRequest], int]:
+        """
+        Разбирает очередной запрос из buf[start:stop]
+
+        Возвращает запрос и начало следующего, или None, если заголовок получен не полностью.
+        ValueError - если запрос некорректен или его заголовок больше max_head_size
+        """
+        request = _request_pool.pop() if _request_pool else BrowserRequest()
+        try:
+            end = request.parse_into(buf, start, stop)
+        except ValueError:
+            self.release(request)
+            raise
+        if end == -1:
+            self.release(request)
+            if stop - start >= self.max_head_size:
+                raise ValueError("Заголовок запроса больше max_head_size")
+            return None, start
+        return request, end
+
+    def keep_pending(self, connection: ClientConnection, buf: bytearray, start: int, stop: int) -> None:
+        """Сохраняет неразобранный остаток до следующего чтения"""
+        if start < stop:
+            connection.pending = buf[start:stop]
+
+    def release(self, request: BrowserRequest) -> None:
+        """Возвращает обработанный запрос в пул, после этого им пользоваться нельзя"""
+        _request_pool.append(request)
+
+    def respond(
+            self,
+            connection: ClientConnection,
+            data: List[bytes],
+            file: Optional[CachedFile] = None,
+            size: int = 0,
+            keep_alive: bool = False,
+    ) -> None:
+        """Отправляет ответ; остаток дописывается при готовности сокета"""
+        connection.queue(data, file, size, keep_alive)
+        # Пишем сразу: обычно ответ целиком помещается в буфер сокета,
+        # и лишний круг через селектор не нужен
+        if not self.flush(connection):
+            self.selector.modify(connection.sock, selectors.EVENT_WRITE, connection)
+
+    def flush(self, connection: ClientConnection) -> bool:
+        """
+        Дописывает ответ клиенту, True - если ответ отправлен
+
+        После ответа соединение закрывается или, при keep-alive, снова ждет запроса
+        """
+        try:
+            done = connection.flush()
+        except OSError:
+            done = True
+            connection.keep_alive = False
+        if done:
+            if not connection.keep_alive:
+                self.disconnect(connection)
+                return done
+            connection.last_active = time.monotonic()
+            selector = self.selector
+            if selector.get_key(connection.sock).events != selectors.EVENT_READ:
+                selector.modify(connection.sock, selectors.EVENT_READ, connection)
+        return done
+
+    def close_idle(self) -> None:
+        """
+        Закрывает keep-alive соединения, простаивающие дольше keep_alive_timeout
+
+        Заодно возобновляет прием клиентов, приостановленный в accept
+        """
+        now = time.monotonic()
+        # Проверяем не чаще раза в секунду
+        if now - self._last_sweep < 1:
+            return
+        self._last_sweep = now
+        self.drop_idle(self.keep_alive_timeout)
+        if self._accept_paused and self._socket is not None:
+            self._accept_paused = False
+            self.selector.register(self._socket, selectors.EVENT_READ)
+
+    def drop_idle(self, timeout: float) -> int:
+        """Закрывает соединения, ждущие запроса дольше timeout секунд, и возвращает их число"""
+        now = time.monotonic()
+        dropped = 0
+        for key in list(self.selector.get_map().values()):
+            connection = key.data
+            if (connection is not None and key.events == selectors.EVENT_READ
+                    and now - connection.last_active > timeout):
+                self.disconnect(connection)
+                dropped += 1
+        return dropped
+
+    def disconnect(self, connection: ClientConnection) -> None:
+        self.selector.unregister(connection.sock)
+        connection.close()
 
 
 class WebServer:
     """Класс сервера"""
 
+    __slots__ = (
+        "socket", "homedir", "workers", "_children", "file_cache_max_file_size", "_homedir_b", "_routes",
+        "_not_found", "_file_cache"
+    )
+
     STATUSES = {
-        200: "Ok",
-        404: "File not found",
-        403: "Forbidden"
+        200: b"Ok",
+        400: b"Bad Request",
+        404: b"File not found",
+        403: b"Forbidden"
     }
 
-    def __init__(self, config: dict, port: int = 80):
+    HEADER_TEMPLATE = b"HTTP/1.1 %d %s\r\nContent-Type: %s\r\nConnection: %s\r\nServer: MyServer\r\n%s%s"
+
+    # Закодированные неизменяемые части заголовков по (код ответа, mime-тип, keep-alive, gzip)
+    _header_cache: ClassVar[Dict[Tuple[int, str, bool, bool], bytes]] = {}
+
+    # Типы, которые имеет смысл сжимать, помимо text/*
+    COMPRESSIBLE_TYPES = ["application/javascript", "application/json", "application/xml", "image/svg+xml"]
+
+    ALLOWED_EXTENSIONS = ["js", "html", "css", "png", "jpg"]
+
+    ROUTES = {
+        "/": "index.html",
+        "/index.html": "index.html",
+        "/index": "index.html",
+        "/test": "cat.meow",
+        "/image": "image.jpg"
+    }
+
+    # Сколько файлов держим в памяти и до какого размера
+    FILE_CACHE_SIZE = 64
+    FILE_CACHE_MAX_FILE_SIZE = 64 * 1024
+
+    def __init__(self, config: Dict[str, Any], port: int = 80):
         """
         Инициализирует сервер
 
         port    -- порт, на котором разворачивается
         homedir -- домашняя директория
+        buffer_size   -- сколько байт читать из сокета за раз
+        max_head_size -- наибольший размер заголовка запроса, на больший сервер отвечает 400
+        max_queued_connections -- длина очереди соединений, ожидающих accept
+        keep_alive_timeout -- сколько секунд держать простаивающее соединение
+        workers -- число рабочих процессов, по умолчанию один;
+                   0 - по числу ядер
+        file_cache_max_file_size -- файлы больше этого размера не копируются
+                                    в память, а отдаются через sendfile
         """
-        self.socket = LocaleSocket(port=port, buffer_size=config["buffer_size"])
+        self.socket = LocaleSocket(
+            port=port,
+            buffer_size=config["buffer_size"],
+            max_head_size=config.get("max_head_size", 8192),
+            max_queued_connections=config.get("max_queued_connections", socket.SOMAXCONN),
+            keep_alive_timeout=config.get("keep_alive_timeout", 5.0),
+        )
         self.homedir = os.path.abspath(config["homedir"])
+        self.workers: int = config.get("workers", 1) or os.cpu_count() or 1
+        # PID рабочих процессов, за которыми следит родительский процесс
+        self._children: List[int] = []
+        self.file_cache_max_file_size: int = config.get("file_cache_max_file_size", self.FILE_CACHE_MAX_FILE_SIZE)
+        # Префикс пути в байтах, чтобы не вызывать os.path.join на каждый запрос
+        self._homedir_b = os.fsencode(self.homedir) + os.sep.encode()
+        # Маршруты разрешаются один раз, а не на каждый запрос
+        self._routes = self.build_routes()
+        self._not_found: Tuple[bytes, int, str] = (self._homedir_b + b"404.html", 404, "text/html")
+        # LRU-кэш файлов по пути
+        self._file_cache: "OrderedDict[bytes, CacheEntry]" = OrderedDict()
+
+    def start(self) -> None:
+        """
+        Запуск web-сервера
 
-    def start(self):
-        """Запуск web-сервера"""
-        self.socket.open()
-        logger.info(f"Запустили web-сервер на порту {self.socket.host}:{self.socket.port}, директория {self.homedir}")
+        С одним рабочим процессом запросы обслуживаются в текущем процессе.
+        Иначе текущий процесс только следит за рабочими и завершает их при остановке
+        """
+        if self.workers == 1:
+            self.socket.open()
+            self.serve_forever()
+            return
+        # Порт занимается до fork, чтобы порт 0 был выбран один раз на все процессы.
+        # Сокет родителя не слушает, поэтому соединения на него не распределяются
+        self.socket.open(listen=False)
+        # Поток записи логов не переживает fork: останавливаем его
+        # и запускаем заново в каждом процессе
+        log_listener.stop()
+        for _ in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker()
+            self._children.append(pid)
+        log_listener.start()
+        # По SIGTERM родитель выходит через stop() и завершает рабочие процессы
+        signal.signal(signal.SIGTERM, self._on_sigterm)
+        logger.info(
+            "Запустили web-сервер (pid %d, рабочих процессов %d) на порту %s:%d, директория %s",
+            os.getpid(), self.workers, self.socket.host, self.socket.port, self.homedir)
+        while self._children:
+            pid, status = os.wait()
+            if pid in self._children:
+                self._children.remove(pid)
+                logger.warning("Рабочий процесс %d завершился (статус %d)", pid, status)
+
+    @staticmethod
+    def _on_sigterm(signum: int, frame: Optional[FrameType]) -> NoReturn:
+        raise SystemExit(0)
+
+    def run_worker(self) -> NoReturn:
+        """Обслуживает запросы в рабочем процессе, из функции не возвращается"""
+        self._children = []
+        log_listener.start()
+        try:
+            # Каждый рабочий процесс открывает свой сокет на том же порту
+            self.socket.close()
+            self.socket.open()
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            logger.exception("Рабочий процесс %d завершился с ошибкой", os.getpid())
+        finally:
+            log_listener.stop()
+            # Обработчики atexit и finally родителя в рабочем процессе не нужны
+            os._exit(1)
+
+    def serve_forever(self) -> None:
+        """Цикл обработки событий на открытом сокете"""
+        logger.info(
+            "Запустили web-сервер (pid %d) на порту %s:%d, директория %s",
+            os.getpid(), self.socket.host, self.socket.port, self.homedir)
         while True:
-            self.new_client_request()
-
-    def stop(self):
-        """Приостановка работы web-сервера"""
-        self.socket.close()
+            for key, mask in self.socket.poll(1):
+                if key.data is None:
+                    self.socket.accept()
+                elif mask & selectors.EVENT_READ:
+                    self.new_client_request(key.data)
+                elif mask & selectors.EVENT_WRITE:
+                    if self.socket.flush(key.data):
+                        self.serve_pending(key.data)
+            self.socket.close_idle()
+
+    def stop(self) -> None:
+        """Приостановка работы web-сервера и завершение рабочих процессов"""
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self._children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self._children = []
+        if self.socket.is_open:
+            self.socket.close()
 
     def router(self, path: str) -> Tuple[bytes, int, str]:
         """Роутер для ассоциации между путями и файлами"""
-
-        allowed_extensions = ["js", "html", "css", "png", "jpg"]
-
-        router_dict = {
-            "/": "index.html",
-            "/index.html": "index.html",
-            "/index": "index.html",
-            "/test": "cat.meow",
-            "/image": "image.jpg"
-        }
-
-        # Если такой маппинг действительно существует
-        if path in router_dict:
-
-            # Имя файла, которое запрашиваем
-            file_name = router_dict[path]
+        # Если ничего подобного нет, то 404
+        return self._routes.get(path, self._not_found)
+
+    def build_routes(self) -> Dict[str, Tuple[bytes, int, str]]:
+        """Разрешает маршруты в пути к файлам, коды ответа и mime-типы"""
+        mime = magic.Magic(mime=True)
+        forbidden = (self._homedir_b + b"403.html", 403, "text/html")
+        routes: Dict[str, Tuple[bytes, int, str]] = {}
+        for path, file_name in self.ROUTES.items():
             # Если это разрешенное имя файла
-            if file_name.split(".")[1] in allowed_extensions:
-                path_str = os.path.join(self.homedir, file_name)
-                mime = magic.Magic(mime=True)
-                mime_str = mime.from_file(path_str)
-                with open(path_str, "rb") as f:
-                    return f.read(), 200, mime_str
+            if file_name.split(".")[1] in self.ALLOWED_EXTENSIONS:
+                path_b = self._homedir_b + file_name.encode()
+                routes[path] = (path_b, 200, mime.from_file(path_b))
             # Ошибка 403
             else:
-                with open(os.path.join(self.homedir, "403.html"), "rb") as f:
-                    return f.read(), 403, "text/html"
+                routes[path] = forbidden
+        return routes
 
-        # Если ничего подобного нет, то 404
-        else:
-            with open(os.path.join(self.homedir, "404.html"), "rb") as f:
-                return f.read(), 404, "text/html"
+    def load_file(self, path_b: bytes, use_gzip: bool = False) -> Tuple[Union[bytes, CachedFile], int, bool]:
+        """
+        Загружает файл для ответа
 
-    def new_client_request(self):
+        Файлы держатся в LRU-кэше, пока не изменится их mtime: небольшие - в памяти,
+        большие - открытыми, чтобы отдавать их через sendfile без повторного open.
+        use_gzip -- отдать сжатую копию, если она есть в кэше или ее стоит создать
+
+        Возвращает тело ответа, его размер и признак сжатия
+        """
+        cached = self._file_cache.get(path_b)
+        if cached is None or cached.mtime != os.stat(path_b).st_mtime:
+            fd = os.open(path_b, os.O_RDONLY)
+            stat = os.fstat(fd)
+            if stat.st_size > self.file_cache_max_file_size:
+                cached = CacheEntry(CachedFile(fd), stat.st_mtime, stat.st_size)
+            else:
+                try:
+                    content = os.read(fd, stat.st_size)
+                finally:
+                    os.close(fd)
+                cached = CacheEntry(content, stat.st_mtime, stat.st_size)
+            self._file_cache[path_b] = cached
+        self._file_cache.move_to_end(path_b)
+        if len(self._file_cache) > self.FILE_CACHE_SIZE:
+            self._file_cache.popitem(last=False)
+
+        body = cached.body
+        if not isinstance(body, bytes):
+            return body, cached.size, False
+        if use_gzip:
+            # Сжимаем один раз, при первом запросе с Accept-Encoding: gzip
+            if cached.gz is None:
+                compressed = gzip.compress(body, 6, mtime=0)
+                # Маленькие файлы после сжатия могут стать только больше
+                cached.gz = compressed if len(compressed) < len(body) else body
+            body = cached.gz
+        return body, len(body), body is not cached.body
+
+    def new_client_request(self, connection: ClientConnection) -> None:
         """"Обработка запроса клиента"""
-        cli_request, ip_addr = self.socket.listen()
+        received = self.socket.recv(connection)
+        if received is not None:
+            buf, stop = received
+            self.serve(connection, buf, 0, stop)
+
+    def serve_pending(self, connection: ClientConnection) -> None:
+        """Отвечает на запросы, принятые, пока отправлялся предыдущий ответ"""
+        buf, connection.pending = connection.pending, bytearray()
+        self.serve(connection, buf, 0, len(buf))
+
+    def serve(self, connection: ClientConnection, buf: bytearray, start: int, stop: int) -> None:
+        """
+        Отвечает по очереди на все запросы, полностью принятые в buf[start:stop]
+
+        Следующий запрос разбирается, только когда предыдущий ответ отправлен целиком,
+        неразобранный остаток ждет следующего чтения или окончания отправки
+        """
+        while not connection.closed and not connection.sending:
+            try:
+                cli_request, start = self.socket.next_request(buf, start, stop)
+            except ValueError:
+                self.bad_request(connection)
+                return
+            if cli_request is None:
+                break
+            self.handle_request(connection, cli_request)
+        if not connection.closed:
+            self.socket.keep_pending(connection, buf, start, stop)
+
+    def bad_request(self, connection: ClientConnection) -> None:
+        """Отвечает 400 на некорректный запрос и закрывает соединение"""
+        self.socket.respond(connection, [self.get_header(400, 0, "text/html")])
+        logger.info("%s -> %s, - 400", utils.get_date(), connection.address[0])
+
+    def handle_request(self, connection: ClientConnection, cli_request: BrowserRequest) -> None:
+        """Отвечает на один запрос клиента"""
+        ip_addr = connection.address[0]
         path = cli_request.path
         # Получаем результат существования файла от роутера
-        body, status_code, mime = self.router(path)
-        header = self.get_header(status_code, body, mime)
-        self.socket.send(header.encode() + body)
-        logger.info(
-            f"{utils.get_date()} -> {ip_addr}, {path} {status_code} - {cli_request.method} {cli_request.user_agent}")
-
-    def get_header(self, status_code: int, body: bytes, mime: str):
+        path_b, status_code, mime = self.router(path)
+        use_gzip = self.is_compressible(mime) and "gzip" in cli_request.get("Accept-Encoding")
+        body, size, gzipped = self.load_file(path_b, use_gzip)
+        keep_alive = cli_request.keep_alive
+        header = self.get_header(status_code, size, mime, keep_alive, gzipped)
+        if isinstance(body, bytes):
+            self.socket.respond(connection, [header, body], keep_alive=keep_alive)
+        else:
+            self.socket.respond(connection, [header], body, size, keep_alive)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("%s -> %s, %s %d - %s %s", utils.get_date(), ip_addr, path, status_code,
+                        cli_request.method, getattr(cli_request, "user_agent", "-"))
+        self.socket.release(cli_request)
+
+    def is_compressible(self, mime: str) -> bool:
+        """Можно ли отдавать файл этого типа сжатым"""
+        return mime.startswith("text/") or mime in self.COMPRESSIBLE_TYPES
+
+    def get_header(self, status_code: int, size: int, mime: str, keep_alive: bool = False,
+                   gzipped: bool = False) -> bytes:
         """Получает заголовок для ответа сервера"""
-        return "\n".join(
-            [
-                f"HTTP/1.1 {status_code} {self.STATUSES[status_code]}",
-                f"Content-Type: {mime}",
-                f"Date: {utils.get_date()}",
-                f"Content-length: {len(body)}",
-                "Connection: close"
-                "Server: MyServer" "\n\n",
-            ]
-        )
+        key = (status_code, mime, keep_alive, gzipped)
+        try:
+            prefix = self._header_cache[key]
+        except KeyError:
+            prefix = self.HEADER_TEMPLATE % (
+                status_code,
+                self.STATUSES[status_code],
+                mime.encode(),
+                b"keep-alive" if keep_alive else b"close",
+                b"Content-Encoding: gzip\r\n" if gzipped else b"",
+                b"Vary: Accept-Encoding\r\n" if self.is_compressible(mime) else b"",
+            )
+            self._header_cache[key] = prefix
+        return b"%sDate: %s\r\nContent-length: %d\r\n\r\n" % (prefix, utils.get_date().encode(), size)
 
 
-def main():
+def main() -> None:
     # Чтение конфигурации сервера
     config = read_config()
     default_port = config["default_port"]
@@ -206,27 +876,22 @@ def main():
     # Тут проверка на то, занят ли порт
     port_flag = port_validation(port_input, check_open=True)
 
-    if not port_flag:
-
-        port_input = default_port
-        # Если порт по-умолчанию уже занят, то перебираем свободные порты
+    if port_flag:
+        port = int(port_input)
+    else:
+        port = default_port
+        # Если порт по-умолчанию уже занят, то свободный порт выберет система
         if not check_port_open(default_port):
-            logger.info(
-                f"Порт по умолчанию {default_port} уже занят! Подбираем рандомный порт.."
-            )
-            stop_flag = False
-            current_port = None
-            while not stop_flag:
-                current_port = random.randint(49152, 65535)
-                logger.info(f"Сгенерировали рандомный порт {current_port}")
-                stop_flag = check_port_open(current_port)
-
-            port_input = current_port
-        logger.info(f"Выставили порт {port_input} по умолчанию")
-
-    web_server = WebServer(config=config, port=int(port_input))
-    web_server.start()
-    web_server.stop()
+            logger.info("Порт по умолчанию %d уже занят! Порт будет выбран системой", default_port)
+            port = 0
+        else:
+            logger.info("Выставили порт %s по умолчанию", port)
+
+    web_server = WebServer(config=config, port=port)
+    try:
+        web_server.start()
+    finally:
+        web_server.stop()
 
 
 if __name__ == "__main__":